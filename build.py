@@ -1,19 +1,116 @@
+import argparse
+import asyncio
 import csv
-import json
+import hashlib
+import multiprocessing
 import os
 import sqlite3
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import msgspec
+import orjson
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
+# apsw wraps the SQLite C API with less per-call overhead than sqlite3;
+# use it for the insert-heavy build when available
+try:
+    import apsw
+except ImportError:
+    apsw = None
+from openai import APIConnectionError, AsyncOpenAI, OpenAI, RateLimitError
 
 # Load environment variables from .env file
 load_dotenv('.env')
 
 # Get OpenAI API key from environment variable
 client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+async_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-# Function to create database tables
-def create_tables(conn):
+# Model used for all completion requests
+MODEL = "gpt-4o-mini"
+
+# Bump when the prompt changes to invalidate cached responses
+PROMPT_VERSION = 1
+
+# Number of concurrent API requests in direct (non-batch) mode
+DIRECT_CONCURRENCY = 10
+
+# Number of lemmas packed into one chat request in direct mode
+GROUP_SIZE = 10
+
+# Default rate limits for direct mode (gpt-4o-mini tier 1)
+DEFAULT_MAX_RPM = 500
+DEFAULT_MAX_TPM = 200000
+
+# Rough allowance for completion tokens when estimating request cost
+COMPLETION_TOKEN_ESTIMATE = 1500
+
+# Maximum attempts per request before giving up
+MAX_ATTEMPTS = 5
+
+# Direct-mode responses are appended here as they complete
+DIRECT_RESULTS_FILE = "direct_results_lemmas.jsonl"
+
+# Lemmas actually submitted to the Batch API, so process_batch maps
+# custom_id indices against the filtered list, not the raw input file
+SUBMITTED_LEMMAS_FILE = "batch_submitted_lemmas.tsv"
+
+# Commit once per this many lemmas instead of per lemma
+COMMIT_BATCH_SIZE = 200
+
+# Tasks per Batch API shard; capped so each upload stays well under the
+# Batch API file-size limit and shards upload/download in parallel
+SHARD_SIZE = 50000
+
+# IDs of the submitted batch jobs, one per shard
+JOB_IDS_FILE = "batch_job_ids.json"
+
+# Pragmas tuned for bulk loading: WAL avoids an fsync per commit, and
+# NORMAL sync with a large page cache further cuts disk traffic
+BUILD_PRAGMAS = '''PRAGMA journal_mode=WAL;
+                   PRAGMA synchronous=NORMAL;
+                   PRAGMA temp_store=MEMORY;
+                   PRAGMA cache_size=-262144;
+                   PRAGMA mmap_size=268435456;'''
+
+# New helper: run a multi-statement script on either connection type
+def execute_script(conn, sql):
+    if apsw is not None:
+        # apsw pauses at each row-returning statement (e.g. PRAGMA
+        # journal_mode) until the cursor is drained, so exhaust it to
+        # make sure every statement in the script runs
+        for _ in conn.execute(sql):
+            pass
+    else:
+        conn.executescript(sql)
+
+# Function to open the database with pragmas tuned for bulk loading.
+# Both apsw and autocommit-mode sqlite3 leave transaction control to
+# explicit BEGIN/COMMIT statements, so the two behave identically here.
+def connect_db():
+    if apsw is not None:
+        conn = apsw.Connection('dictionary.db')
+    else:
+        conn = sqlite3.connect('dictionary.db', isolation_level=None)
+    execute_script(conn, BUILD_PRAGMAS)
+    return conn
+
+# Transaction control via statements, shared by both connection types
+def begin_transaction(conn):
+    conn.execute("BEGIN")
+
+def commit_transaction(conn):
+    conn.execute("COMMIT")
+
+# Function to checkpoint the WAL and close the connection
+def close_db(conn):
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+# Function to create database tables; index creation can be deferred so
+# bulk loads don't pay b-tree maintenance on every insert
+def create_tables(conn, with_indexes=True):
     cursor = conn.cursor()
     
     # Table for lemmas with input part of speech
@@ -67,57 +164,116 @@ def create_tables(conn):
                         FOREIGN KEY (entry_id) REFERENCES entries (entry_id)
                       )''')
     
-    # Create indexes for efficient querying
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_lemmas_lemma ON lemmas (lemma)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_words_word ON words (word)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_words_lemma_id ON words (lemma_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_entries_lemma_id ON entries (lemma_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_definitions_entry_id ON definitions (entry_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_synonyms_entry_id ON synonyms (entry_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_antonyms_entry_id ON antonyms (entry_id)')
+    # Cache of raw API responses so reruns skip already-fetched lemmas
+    cursor.execute('''CREATE TABLE IF NOT EXISTS llm_cache (
+                        key TEXT PRIMARY KEY,
+                        response_json TEXT
+                      )''')
     
-    conn.commit()
+    if with_indexes:
+        create_indexes(conn)
+
+# Function to create the query indexes; during a build this runs once
+# after the load instead of maintaining the b-trees insert by insert
+def create_indexes(conn):
+    execute_script(conn, '''CREATE INDEX IF NOT EXISTS idx_lemmas_lemma ON lemmas (lemma);
+                          CREATE INDEX IF NOT EXISTS idx_words_word ON words (word);
+                          CREATE INDEX IF NOT EXISTS idx_words_lemma_id ON words (lemma_id);
+                          CREATE INDEX IF NOT EXISTS idx_entries_lemma_id ON entries (lemma_id);
+                          CREATE INDEX IF NOT EXISTS idx_definitions_entry_id ON definitions (entry_id);
+                          CREATE INDEX IF NOT EXISTS idx_synonyms_entry_id ON synonyms (entry_id);
+                          CREATE INDEX IF NOT EXISTS idx_antonyms_entry_id ON antonyms (entry_id);
+                          ANALYZE;''')
+
+# Typed views of the API response schema; msgspec validates and builds
+# these in one C pass, and attribute access beats dict indexing downstream
+class Entry(msgspec.Struct):
+    part_of_speech: str
+    definitions: list[str]
+    synonyms: list[str]
+    antonyms: list[str]
+
+class LemmaResponse(msgspec.Struct):
+    lemma: str
+    word_forms: list[str]
+    entries: list[Entry]
+
+class GroupResponse(msgspec.Struct):
+    results: list[LemmaResponse]
+
+# INSERT statements shared by every insert_lemma_entries call, so SQLite
+# reparses each statement once per executemany instead of once per row
+LEMMA_SQL = '''INSERT INTO lemmas (lemma, input_part_of_speech) VALUES (?, ?)
+               ON CONFLICT (lemma) DO UPDATE SET lemma = lemma
+               RETURNING lemma_id'''
+WORD_SQL = "INSERT OR IGNORE INTO words (word, lemma_id) VALUES (?, ?)"
+ENTRY_SQL = "INSERT INTO entries (lemma_id, part_of_speech, order_index) VALUES (?, ?, ?) RETURNING entry_id"
+DEFINITION_SQL = "INSERT INTO definitions (entry_id, definition, order_index) VALUES (?, ?, ?)"
+SYNONYM_SQL = "INSERT INTO synonyms (entry_id, synonym, order_index) VALUES (?, ?, ?)"
+ANTONYM_SQL = "INSERT INTO antonyms (entry_id, antonym, order_index) VALUES (?, ?, ?)"
 
 # Function to insert lemma, its word forms, and entries into the database
 def insert_lemma_entries(conn, lemma, input_pos, word_forms, entries):
     cursor = conn.cursor()
-    
-    # Insert lemma with its input part of speech if not exists
-    cursor.execute("INSERT OR IGNORE INTO lemmas (lemma, input_part_of_speech) VALUES (?, ?)", (lemma, input_pos))
-    cursor.execute("SELECT lemma_id FROM lemmas WHERE lemma = ?", (lemma,))
+
+    # Insert lemma with its input part of speech if not exists; RETURNING
+    # (SQLite >= 3.35) yields the lemma_id in the same statement, avoiding
+    # a follow-up SELECT per lemma
+    cursor.execute(LEMMA_SQL, (lemma, input_pos))
     lemma_id = cursor.fetchone()[0]
-    
-    # Insert word forms
-    for word_form in word_forms:
-        cursor.execute("INSERT OR IGNORE INTO words (word, lemma_id) VALUES (?, ?)", (word_form, lemma_id))
-    
-    # Insert each entry (part of speech from API)
+
+    # Insert word forms in one batch
+    cursor.executemany(WORD_SQL, ((word_form, lemma_id) for word_form in word_forms))
+
+    # Insert the entries (parts of speech from API), collecting their ids;
+    # RETURNING works on both sqlite3 and apsw cursors, unlike lastrowid
+    entry_ids = []
     for entry_index, entry in enumerate(entries):
-        part_of_speech = entry['part_of_speech']
-        cursor.execute('''INSERT INTO entries (lemma_id, part_of_speech, order_index)
-                          VALUES (?, ?, ?)''', (lemma_id, part_of_speech, entry_index))
-        entry_id = cursor.lastrowid
-        
-        # Insert definitions
-        for def_index, definition in enumerate(entry['definitions']):
-            cursor.execute('''INSERT INTO definitions (entry_id, definition, order_index)
-                              VALUES (?, ?, ?)''', (entry_id, definition, def_index))
-        
-        # Insert synonyms
-        for syn_index, synonym in enumerate(entry['synonyms']):
-            cursor.execute('''INSERT INTO synonyms (entry_id, synonym, order_index)
-                              VALUES (?, ?, ?)''', (entry_id, synonym, syn_index))
-        
-        # Insert antonyms
-        for ant_index, antonym in enumerate(entry['antonyms']):
-            cursor.execute('''INSERT INTO antonyms (entry_id, antonym, order_index)
-                              VALUES (?, ?, ?)''', (entry_id, antonym, ant_index))
-    
-    conn.commit()
+        cursor.execute(ENTRY_SQL, (lemma_id, entry.part_of_speech, entry_index))
+        entry_ids.append(cursor.fetchone()[0])
 
-# New helper: Build prompt for a lemma
-def build_prompt(lemma, input_pos):
-    prompt = f'''Provide the word forms, definitions, synonyms, and antonyms for the lemma "{lemma}" with its primary part of speech code "{input_pos}". Use these one-letter codes for parts of speech:
+    # Insert the child rows of all entries with one executemany per table,
+    # fed by generators so no intermediate row lists are built
+    cursor.executemany(DEFINITION_SQL, ((entry_id, definition, def_index)
+                                        for entry_id, entry in zip(entry_ids, entries)
+                                        for def_index, definition in enumerate(entry.definitions)))
+
+    cursor.executemany(SYNONYM_SQL, ((entry_id, synonym, syn_index)
+                                     for entry_id, entry in zip(entry_ids, entries)
+                                     for syn_index, synonym in enumerate(entry.synonyms)))
+
+    cursor.executemany(ANTONYM_SQL, ((entry_id, antonym, ant_index)
+                                     for entry_id, entry in zip(entry_ids, entries)
+                                     for ant_index, antonym in enumerate(entry.antonyms)))
+
+# New helper: read lemma/part-of-speech pairs from a TSV file.
+# A 1 MiB read buffer keeps csv.reader fed from large files.
+def read_lemmas(path='lemmas.tsv'):
+    try:
+        with open(path, 'r', buffering=1<<20, newline='') as file:
+            reader = csv.reader(file, delimiter='\t')
+            next(reader)  # Skip header
+            return [(row[0].strip().lower(), row[1].strip().lower()) for row in reader if len(row) >= 2]
+    except FileNotFoundError:
+        print(f"Error: '{path}' not found.")
+        sys.exit(1)
+
+# New helper: drop duplicate input rows and lemmas already in the database,
+# so incremental builds only pay for lemmas that are actually new
+def filter_new_lemmas(conn, lemma_pos_pairs):
+    # Keep only the first row per lemma: lemmas.tsv lists some lemmas under
+    # two parts of speech, but the schema stores one input part of speech
+    # per lemma and the response covers all parts of speech anyway, so a
+    # second row would just insert the same entries twice
+    unique = {}
+    for lemma, input_pos in lemma_pos_pairs:
+        unique.setdefault(lemma, input_pos)
+    done = {row[0] for row in conn.execute("SELECT lemma FROM lemmas")}
+    return [(lemma, input_pos) for lemma, input_pos in unique.items() if lemma not in done]
+
+# Static prompt text, built once at module load; build_prompt and
+# build_group_prompt only substitute the varying fields per call
+PROMPT_TEMPLATE = '''Provide the word forms, definitions, synonyms, and antonyms for the lemma "{lemma}" with its primary part of speech code "{input_pos}". Use these one-letter codes for parts of speech:
 a: article
 c: conjunction
 d: determiner
@@ -151,47 +307,231 @@ Format the response as a JSON object with the following schema:
   ]
 }}
 Include all inflected forms of the lemma in "word_forms" (e.g., for "run": "run", "runs", "running", "ran"). Ensure parts of speech are ordered by common usage, prioritizing "{input_pos}" if applicable, and within each part of speech, definitions, synonyms, and antonyms are ordered by common usage.'''
-    return prompt
 
-# New function: submit batch job
-def submit_batch():
+GROUP_PROMPT_TEMPLATE = '''Provide the word forms, definitions, synonyms, and antonyms for each of the following lemmas:
+{lemma_lines}
+
+Use these one-letter codes for parts of speech:
+a: article
+c: conjunction
+d: determiner
+e: existential there
+i: preposition
+j: adjective
+m: number
+n: noun
+p: pronoun
+r: adverb
+t: infinitive marker
+u: interjection
+v: verb
+x: not
+
+For definition, use sentence fragments, not full sentences.
+Synonyms and antonyms should be single words or short phrases.
+
+Format the response as a JSON object with the following schema:
+{{
+  "results": [
+    {{
+      "lemma": "string",
+      "word_forms": ["string", ...],
+      "entries": [
+        {{
+          "part_of_speech": "single-letter-code",
+          "definitions": ["string", ...],
+          "synonyms": ["string", ...],
+          "antonyms": ["string", ...]
+        }},
+        ...
+      ]
+    }},
+    ...
+  ]
+}}
+Return one results item per lemma, in the order given. Include all inflected forms of each lemma in "word_forms" (e.g., for "run": "run", "runs", "running", "ran"). Ensure parts of speech are ordered by common usage, prioritizing the given part of speech if applicable, and within each part of speech, definitions, synonyms, and antonyms are ordered by common usage.'''
+
+# New helper: Build prompt for a lemma
+def build_prompt(lemma, input_pos):
+    return PROMPT_TEMPLATE.format(lemma=lemma, input_pos=input_pos)
+
+# New helper: Build prompt covering several lemmas at once, so each API
+# request spends one RPM unit on a group instead of a single lemma
+def build_group_prompt(lemma_pos_pairs):
+    lemma_lines = "\n".join(f'- "{lemma}" with primary part of speech code "{input_pos}"' for lemma, input_pos in lemma_pos_pairs)
+    return GROUP_PROMPT_TEMPLATE.format(lemma_lines=lemma_lines)
+
+# New helper: cache key for a lemma request
+def cache_key(lemma, input_pos):
+    return hashlib.sha256(f"{MODEL}|{PROMPT_VERSION}|{lemma}|{input_pos}".encode()).hexdigest()
+
+# New function: fetch data for a group of lemmas from the chat completions
+# API, consulting the response cache first (responses are deterministic at
+# temperature=0, so an exact-match cache is safe). Returns a dict mapping
+# lemma to its result; lemmas the model failed to return are absent.
+async def get_lemma_group_data(conn, lemma_pos_pairs):
+    results = {}
+    misses = []
+    for lemma, input_pos in lemma_pos_pairs:
+        row = conn.execute("SELECT response_json FROM llm_cache WHERE key = ?", (cache_key(lemma, input_pos),)).fetchone()
+        if row:
+            results[lemma] = msgspec.json.decode(row[0], type=LemmaResponse)
+        else:
+            misses.append((lemma, input_pos))
+    if not misses:
+        return results
+    prompt = build_group_prompt(misses)
+    response = await async_client.chat.completions.create(
+        model=MODEL,
+        temperature=0,
+        response_format={ "type": "json_object" },
+        messages=[
+            { "role": "system", "content": "You are a helpful assistant that provides word forms, definitions, synonyms, and antonyms in JSON format." },
+            { "role": "user", "content": prompt }
+        ]
+    )
+    data = msgspec.json.decode(response.choices[0].message.content, type=GroupResponse)
+    pos_by_lemma = dict(misses)
+    for item in data.results:
+        lemma = item.lemma.lower()
+        if lemma not in pos_by_lemma:
+            print(f"Warning: Response lemma '{item.lemma}' does not match any requested lemma")
+            continue
+        conn.execute("INSERT OR REPLACE INTO llm_cache (key, response_json) VALUES (?, ?)",
+                     (cache_key(lemma, pos_by_lemma[lemma]), msgspec.json.encode(item).decode()))
+        results[lemma] = item
+    return results
+
+# New function: build the database directly, issuing concurrent API requests
+async def run_direct(max_rpm, max_tpm):
     # Read the TSV input file
-    try:
-        with open('lemmas.tsv', 'r', newline='') as file:
-            reader = csv.reader(file, delimiter='\t')
-            next(reader)  # Skip header
-            lemma_pos_pairs = [(row[0].strip().lower(), row[1].strip().lower()) for row in reader if len(row) >= 2]
-    except FileNotFoundError:
-        print("Error: 'lemmas.tsv' not found.")
-        sys.exit(1)
-    
-    tasks = []
-    for idx, (lemma, input_pos) in enumerate(lemma_pos_pairs):
-        prompt = build_prompt(lemma, input_pos)
-        task = {
-            "custom_id": f"task-{idx}",
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": "gpt-4o-mini",
-                "temperature": 0,
-                "response_format": { "type": "json_object" },
-                "messages": [
-                    { "role": "system", "content": "You are a helpful assistant that provides word forms, definitions, synonyms, and antonyms in JSON format." },
-                    { "role": "user", "content": prompt }
-                ]
-            }
+    lemma_pos_pairs = read_lemmas()
+
+    # Connect to SQLite database, deferring index creation until after the load
+    conn = connect_db()
+    create_tables(conn, with_indexes=False)
+    lemma_pos_pairs = filter_new_lemmas(conn, lemma_pos_pairs)
+
+    # A single writer coroutine serializes all DB inserts and persists raw
+    # responses to JSONL so a crash doesn't waste completed requests
+    results_queue = asyncio.Queue()
+
+    async def writer():
+        processed = 0
+        begin_transaction(conn)
+        with open(DIRECT_RESULTS_FILE, 'ab') as results_file:
+            while True:
+                item = await results_queue.get()
+                if item is None:
+                    break
+                lemma, input_pos, data = item
+                # Report per-item failures and keep going; task_done must
+                # always run or the queue join below never finishes
+                try:
+                    results_file.write(msgspec.json.encode({ "lemma": lemma, "input_pos": input_pos, "response": data }) + b"\n")
+                    results_file.flush()
+                    if data.lemma.lower() != lemma:
+                        print(f"Warning: Response lemma '{data.lemma}' does not match input '{lemma}'")
+                    else:
+                        insert_lemma_entries(conn, lemma, input_pos, data.word_forms, data.entries)
+                        processed += 1
+                        if processed % COMMIT_BATCH_SIZE == 0:
+                            commit_transaction(conn)
+                            begin_transaction(conn)
+                        print(f"Processed: {lemma} ({input_pos})")
+                except Exception as e:
+                    print(f"Error processing result for {lemma} ({input_pos}): {e}")
+                finally:
+                    results_queue.task_done()
+        commit_transaction(conn)
+
+    # Token-bucket throttle: track remaining request and token capacity,
+    # refilled continuously against the per-minute limits
+    encoding = tiktoken.encoding_for_model(MODEL)
+    available_request_capacity = float(max_rpm)
+    available_token_capacity = float(max_tpm)
+    last_update_time = time.monotonic()
+    throttle_lock = asyncio.Lock()
+
+    async def acquire_capacity(token_estimate):
+        nonlocal available_request_capacity, available_token_capacity, last_update_time
+        # An estimate above max_tpm could never be satisfied (capacity is
+        # capped there) and would spin forever; clamp it so the request
+        # waits for a full bucket instead
+        token_estimate = min(token_estimate, max_tpm)
+        while True:
+            async with throttle_lock:
+                now = time.monotonic()
+                elapsed = now - last_update_time
+                last_update_time = now
+                available_request_capacity = min(available_request_capacity + max_rpm * elapsed / 60.0, max_rpm)
+                available_token_capacity = min(available_token_capacity + max_tpm * elapsed / 60.0, max_tpm)
+                if available_request_capacity >= 1 and available_token_capacity >= token_estimate:
+                    available_request_capacity -= 1
+                    available_token_capacity -= token_estimate
+                    return
+            await asyncio.sleep(0.1)
+
+    # Bound concurrent API requests with a semaphore
+    semaphore = asyncio.Semaphore(DIRECT_CONCURRENCY)
+
+    async def bounded(group):
+        token_estimate = len(encoding.encode(build_group_prompt(group))) + COMPLETION_TOKEN_ESTIMATE * len(group)
+        for attempt in range(MAX_ATTEMPTS):
+            await acquire_capacity(token_estimate)
+            try:
+                async with semaphore:
+                    group_results = await get_lemma_group_data(conn, group)
+                break
+            except (RateLimitError, APIConnectionError) as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = 2 ** attempt
+                print(f"Retrying group starting at '{group[0][0]}' in {delay}s: {e}")
+                await asyncio.sleep(delay)
+        for lemma, input_pos in group:
+            if lemma in group_results:
+                await results_queue.put((lemma, input_pos, group_results[lemma]))
+            else:
+                print(f"Warning: No response for '{lemma}' ({input_pos})")
+
+    writer_task = asyncio.create_task(writer())
+    groups = [lemma_pos_pairs[i:i + GROUP_SIZE] for i in range(0, len(lemma_pos_pairs), GROUP_SIZE)]
+    tasks = [bounded(group) for group in groups]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            print(f"Error fetching data for group starting at '{group[0][0]}': {result}")
+
+    # Drain the queue and stop the writer
+    await results_queue.join()
+    await results_queue.put(None)
+    await writer_task
+
+    create_indexes(conn)
+    close_db(conn)
+    print("Dictionary and thesaurus build complete.")
+
+# New helper: build one Batch API task for a lemma
+def build_task(idx, lemma, input_pos):
+    prompt = build_prompt(lemma, input_pos)
+    return {
+        "custom_id": f"task-{idx}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": MODEL,
+            "temperature": 0,
+            "response_format": { "type": "json_object" },
+            "messages": [
+                { "role": "system", "content": "You are a helpful assistant that provides word forms, definitions, synonyms, and antonyms in JSON format." },
+                { "role": "user", "content": prompt }
+            ]
         }
-        tasks.append(task)
-    
-    # Write batch tasks file
-    tasks_file = "batch_tasks_lemmas.jsonl"
-    with open(tasks_file, 'w') as file:
-        for task in tasks:
-            file.write(json.dumps(task) + "\n")
-    print(f"Batch tasks file created: {tasks_file}")
-    
-    # Upload file and create batch job
+    }
+
+# New helper: upload one tasks file and create its batch job
+def submit_tasks_file(tasks_file):
     batch_file = client.files.create(
         file=open(tasks_file, "rb"),
         purpose="batch"
@@ -201,80 +541,196 @@ def submit_batch():
         endpoint="/v1/chat/completions",
         completion_window="24h"
     )
-    # Save job ID for processing later
-    with open("batch_job_id.txt", "w") as f:
-        f.write(batch_job.id)
-    print(f"Batch job submitted. Job ID: {batch_job.id}")
+    print(f"Batch job submitted for {tasks_file}. Job ID: {batch_job.id}")
+    return batch_job.id
+
+# New helper: upload shard files in parallel and save the job IDs for
+# processing later; uploads are I/O-bound, so threads divide the wall time
+def submit_tasks_files(tasks_files):
+    with ThreadPoolExecutor(max_workers=len(tasks_files)) as executor:
+        job_ids = list(executor.map(submit_tasks_file, tasks_files))
+    with open(JOB_IDS_FILE, 'wb') as f:
+        f.write(orjson.dumps(job_ids))
+
+# New function: submit batch job
+def submit_batch():
+    # Read the TSV input file and skip lemmas the database already has
+    lemma_pos_pairs = read_lemmas()
+    conn = connect_db()
+    # Leave index creation to the load in process_batch; the full-table
+    # scan in filter_new_lemmas doesn't need them
+    create_tables(conn, with_indexes=False)
+    lemma_pos_pairs = filter_new_lemmas(conn, lemma_pos_pairs)
+    conn.close()
+    if not lemma_pos_pairs:
+        print("All lemmas are already in the database; nothing to submit.")
+        return
+    
+    # Record the submitted lemmas so process_batch indexes the same list
+    with open(SUBMITTED_LEMMAS_FILE, 'w', newline='') as file:
+        file.write("lemma\tPoS\n")
+        for lemma, input_pos in lemma_pos_pairs:
+            file.write(f"{lemma}\t{input_pos}\n")
+    
+    # Write batch task shards, building and serializing each task in one
+    # pass so peak memory stays flat no matter how many lemmas there are;
+    # orjson serializes in C and the 1 MiB buffer keeps writes large
+    tasks_files = []
+    for shard_start in range(0, len(lemma_pos_pairs), SHARD_SIZE):
+        tasks_file = f"batch_tasks_lemmas_{len(tasks_files)}.jsonl"
+        with open(tasks_file, 'wb', buffering=1<<20) as file:
+            for offset, (lemma, input_pos) in enumerate(lemma_pos_pairs[shard_start:shard_start + SHARD_SIZE]):
+                file.write(orjson.dumps(build_task(shard_start + offset, lemma, input_pos)))
+                file.write(b"\n")
+        tasks_files.append(tasks_file)
+        print(f"Batch tasks file created: {tasks_file}")
+    
+    # Upload the shards and create their batch jobs
+    submit_tasks_files(tasks_files)
+
+# New helper: parse one line of batch output into (idx, LemmaResponse).
+# Module-level so multiprocessing workers can pickle it; returns an error
+# string instead of raising so the pool keeps going.
+def parse_result_line(line):
+    task_id = ""
+    try:
+        obj = orjson.loads(line)
+        task_id = obj.get("custom_id", "")
+        idx = int(task_id.split("-")[-1])
+        # Get the API response contained in response.body.choices[0].message.content
+        api_resp = obj["response"]["body"]["choices"][0]["message"]["content"]
+        return idx, msgspec.json.decode(api_resp, type=LemmaResponse), None
+    except Exception as e:
+        return None, None, f"Error processing result for task {task_id}: {e}"
+
+# New helper: stream one file from the API to disk in 1 MB chunks, so
+# memory stays constant regardless of the file size
+def download_file(file_id, path):
+    with client.files.with_streaming_response.content(file_id) as response, open(path, "wb") as file:
+        for chunk in response.iter_bytes(1 << 20):
+            file.write(chunk)
+    return path
 
 # New function: process batch job results and update the database
 def process_batch():
-    # Read job ID from file
+    # Read job IDs from file
     try:
-        with open("batch_job_id.txt", "r") as f:
-            job_id = f.read().strip()
+        with open(JOB_IDS_FILE, "rb") as f:
+            job_ids = orjson.loads(f.read())
     except FileNotFoundError:
-        print("No batch job ID found. Please run 'submit' command first.")
+        print("No batch job IDs found. Please run 'submit' command first.")
         sys.exit(1)
     
-    # Retrieve batch job
-    batch_job = client.batches.retrieve(job_id)
-    if batch_job.status != "completed":
-        print(f"Batch job not complete yet. Current status: {batch_job.status}")
+    # Retrieve the batch jobs; all shards must be finished before processing
+    batch_jobs = [client.batches.retrieve(job_id) for job_id in job_ids]
+    incomplete = [job for job in batch_jobs if job.status != "completed"]
+    if incomplete:
+        for job in incomplete:
+            print(f"Batch job {job.id} not complete yet. Current status: {job.status}")
         sys.exit(0)
     
-    # Download results
-    result_file_id = batch_job.output_file_id
-    result_content = client.files.content(result_file_id).content
-    results_file = "batch_job_results_lemmas.jsonl"
-    with open(results_file, "wb") as file:
-        file.write(result_content)
-    print(f"Results saved to: {results_file}")
+    # Download all shard results in parallel, streaming each to disk.
+    # A job whose requests all failed completes with no output file; its
+    # tasks are covered by the error summary and resubmission below.
+    jobs_with_output = [job for job in batch_jobs if job.output_file_id]
+    results_files = []
+    if jobs_with_output:
+        with ThreadPoolExecutor(max_workers=len(jobs_with_output)) as executor:
+            results_files = list(executor.map(
+                lambda args: download_file(args[1].output_file_id, f"batch_job_results_lemmas_{args[0]}.jsonl"),
+                enumerate(jobs_with_output)))
+    for results_file in results_files:
+        print(f"Results saved to: {results_file}")
     
-    # Re-read lemmas.tsv to match tasks with input
-    try:
-        with open('lemmas.tsv', 'r', newline='') as file:
-            reader = csv.reader(file, delimiter='\t')
-            next(reader)
-            lemma_pos_pairs = [(row[0].strip().lower(), row[1].strip().lower()) for row in reader if len(row) >= 2]
-    except FileNotFoundError:
-        print("Error: 'lemmas.tsv' not found.")
-        sys.exit(1)
+    # Re-read the submitted lemma list to match tasks with input (fall
+    # back to lemmas.tsv for jobs submitted before the list was recorded)
+    if os.path.exists(SUBMITTED_LEMMAS_FILE):
+        lemma_pos_pairs = read_lemmas(SUBMITTED_LEMMAS_FILE)
+    else:
+        lemma_pos_pairs = read_lemmas()
     
-    # Connect to SQLite database
-    conn = sqlite3.connect('dictionary.db')
-    create_tables(conn)
+    # Connect to SQLite database, deferring index creation until after the load
+    conn = connect_db()
+    create_tables(conn, with_indexes=False)
     
-    # Process each result (custom_id is task-{idx} so idx maps to lemma_pos_pairs)
-    with open(results_file, "r") as file:
-        for line in file:
-            try:
-                obj = json.loads(line.strip())
-                task_id = obj.get("custom_id", "")
-                idx = int(task_id.split("-")[-1])
-                # Get the API response contained in response.body.choices[0].message.content
-                api_resp = obj["response"]["body"]["choices"][0]["message"]["content"]
-                data = json.loads(api_resp)
-                
+    # Process each result (custom_id is task-{idx} so idx maps to
+    # lemma_pos_pairs). Lines are decoded in a worker pool since the JSON
+    # parse is the CPU-bound part; SQLite is single-writer, so inserts stay
+    # on this process. Lemmas already in the database are skipped so
+    # re-processing a result (e.g. after a retry job) never duplicates rows.
+    processed = 0
+    existing = {row[0] for row in conn.execute("SELECT lemma FROM lemmas")}
+    begin_transaction(conn)
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        for results_file in results_files:
+            with open(results_file, "rb") as file:
+                for idx, data, error in pool.imap_unordered(parse_result_line, file, chunksize=64):
+                    if error:
+                        print(error)
+                        continue
+                    if idx >= len(lemma_pos_pairs):
+                        print(f"Warning: task index {idx} is out of range for the submitted lemma list")
+                        continue
+                    lemma, input_pos = lemma_pos_pairs[idx]
+                    if lemma in existing:
+                        print(f"Skipping: {lemma} ({input_pos}) is already in the database")
+                        continue
+                    if data.lemma.lower() != lemma:
+                        print(f"Warning: Response lemma '{data.lemma}' does not match input '{lemma}'")
+                        continue
+                    insert_lemma_entries(conn, lemma, input_pos, data.word_forms, data.entries)
+                    existing.add(lemma)
+                    processed += 1
+                    if processed % COMMIT_BATCH_SIZE == 0:
+                        commit_transaction(conn)
+                        begin_transaction(conn)
+                    print(f"Processed: {lemma} ({input_pos})")
+    commit_transaction(conn)
+    create_indexes(conn)
+    close_db(conn)
+    
+    # Summarize errors reported by the batch jobs, if any
+    error_counts = {}
+    for shard_idx, job in enumerate(batch_jobs):
+        if not job.error_file_id:
+            continue
+        errors_file = download_file(job.error_file_id, f"batch_job_errors_lemmas_{shard_idx}.jsonl")
+        with open(errors_file, "r") as file:
+            for line in file:
+                obj = orjson.loads(line)
+                code = (obj.get("error") or {}).get("code", "unknown")
+                error_counts[code] = error_counts.get(code, 0) + 1
+    for code, count in sorted(error_counts.items()):
+        print(f"Batch error '{code}': {count} task(s)")
+    
+    # Resubmit tasks whose lemma still isn't in the database, so a flaky
+    # run only re-pays for the misses; lemmas completed by an earlier
+    # process run (before a retry job) count as done and are not recycled
+    missing = [idx for idx, (lemma, input_pos) in enumerate(lemma_pos_pairs) if lemma not in existing]
+    if missing:
+        retry_file = "batch_tasks_lemmas_retry.jsonl"
+        with open(retry_file, 'wb', buffering=1<<20) as file:
+            for idx in missing:
                 lemma, input_pos = lemma_pos_pairs[idx]
-                if data.get("lemma", "").lower() != lemma:
-                    print(f"Warning: Response lemma '{data.get('lemma')}' does not match input '{lemma}'")
-                    continue
-                insert_lemma_entries(conn, lemma, input_pos, data.get("word_forms", []), data.get("entries", []))
-                print(f"Processed: {lemma} ({input_pos})")
-            except Exception as e:
-                print(f"Error processing result for task {task_id}: {e}")
-    conn.close()
-    print("Dictionary and thesaurus build complete.")
+                file.write(orjson.dumps(build_task(idx, lemma, input_pos)))
+                file.write(b"\n")
+        print(f"{len(missing)} task(s) missing or failed; resubmitting from {retry_file}")
+        submit_tasks_files([retry_file])
+    else:
+        print("Dictionary and thesaurus build complete.")
 
 # Main execution: check command-line argument to choose mode.
 def main():
-    if len(sys.argv) < 2 or sys.argv[1] not in ("submit", "process"):
-        print("Usage: python build.py [submit|process]")
-        sys.exit(1)
-    command = sys.argv[1]
-    if command == "submit":
+    parser = argparse.ArgumentParser(description="Build the dictionary and thesaurus database.")
+    parser.add_argument("command", choices=["run", "submit", "process"])
+    parser.add_argument("--max-rpm", type=int, default=DEFAULT_MAX_RPM, help="request-per-minute limit for direct mode")
+    parser.add_argument("--max-tpm", type=int, default=DEFAULT_MAX_TPM, help="token-per-minute limit for direct mode")
+    args = parser.parse_args()
+    if args.command == "run":
+        asyncio.run(run_direct(args.max_rpm, args.max_tpm))
+    elif args.command == "submit":
         submit_batch()
-    elif command == "process":
+    elif args.command == "process":
         process_batch()
 
 if __name__ == "__main__":